@@ -1,8 +1,69 @@
 import math, operator, itertools
+from array import array
+
+try:
+    import numpy as np
+    import scipy.sparse
+except ImportError:
+    #numpy and scipy are optional, without them the models fall back to dicts
+    np = None
+
+try:
+    import numba
+except ImportError:
+    #numba is optional, without it scoring uses scipy's matrix-vector product
+    numba = None
+
+def tf_matrix(index):
+    """
+        Builds a sparse matrix of term counts with a row per document.
+        Returns the doc for each row, the column for each term and the matrix
+    """
+    #map documents and terms to contiguous ids for the rows and columns
+    row_docs = []
+    doc_to_id = {}
+    term_to_id = {}
+    doc_ids, term_ids, counts = array('i'), array('i'), array('i')
+    for term,doc_count in index.items():
+        term_id = term_to_id.setdefault(term,len(term_to_id))
+        for doc,count in doc_count.items():
+            doc_id = doc_to_id.get(doc)
+            if doc_id is None:
+                doc_id = doc_to_id[doc] = len(row_docs)
+                row_docs.append(doc)
+            doc_ids.append(doc_id)
+            term_ids.append(term_id)
+            counts.append(count)
+    
+    tf = scipy.sparse.csr_matrix((counts,(doc_ids,term_ids)),shape=(len(row_docs),len(term_to_id)),dtype=float)
+    return row_docs, term_to_id, tf
+
+if numba is not None:
+    @numba.njit(fastmath=True,cache=True)
+    def score_documents(indptr,indices,data,query_terms,query_weights,doc_count):
+        """
+            Dot product of every document with a query. The documents are a CSC
+            matrix so the weights for each query term are contiguous
+        """
+        scores = np.zeros(doc_count)
+        for i in range(len(query_terms)):
+            term = query_terms[i]
+            weight = query_weights[i]
+            for k in range(indptr[term],indptr[term + 1]):
+                scores[indices[k]] += data[k] * weight
+        return scores
 
 class BinaryModel:
-    """Model implementing binary metric"""
+    """
+        Model implementing binary metric.
+        If numpy and scipy are available the metric is a sparse matrix with a
+        row per document, otherwise it is a dict of dicts
+    """
     def __init__(self,retreiver,index):
+        if np is not None:
+            #every count in the index is at least 1
+            self.binary = retreiver.tf.sign()
+            return
         self.binary = {}
         for term,doc_count in index.items():
             for doc,count in doc_count.items():
@@ -15,8 +76,15 @@ class BinaryModel:
         return {term: 1 if count>=1 else 0 for term, count in query.items()}
 
 class TfModel:
-    """Model implementing tf metric"""
+    """
+        Model implementing tf metric.
+        If numpy and scipy are available the metric is a sparse matrix with a
+        row per document, otherwise it is a dict of dicts
+    """
     def __init__(self,retreiver,index):
+        if np is not None:
+            self.tf = retreiver.tf
+            return
         self.tf = {}
         for term,doc_count in index.items():
             for doc,count in doc_count.items():
@@ -29,8 +97,18 @@ class TfModel:
         return query
 
 class TfIdfModel:
-    """Model implementing tf.idf metric"""
+    """
+        Model implementing tf.idf metric.
+        If numpy and scipy are available the metric is a sparse matrix with a
+        row per document, otherwise it is a dict of dicts
+    """
     def __init__(self,retreiver,index):
+        if np is not None:
+            self.term_to_id = retreiver.term_to_id
+            df = np.diff(retreiver.tf.tocsc().indptr)
+            self.idf = np.log(retreiver.tf.shape[0] / df)
+            self.tf_idf = retreiver.tf.multiply(self.idf).tocsr()
+            return
         self.tf = index
         
         self.df = {term: len(doc_count) for term, doc_count in index.items()}
@@ -46,6 +124,10 @@ class TfIdfModel:
         return self.tf_idf
         
     def query_metric(self,query):
+        if np is not None:
+            #terms which are not in the index have no column, they get a weight of
+            #0 for the same reason as the dict case below
+            return {term: tf * self.idf[self.term_to_id[term]] if term in self.term_to_id else 0 for term, tf in query.items()}
         query_tf_idf = {}
         for term, tf in query.items():
             #here we get with a default of 0 (though the idf for a term which does
@@ -67,10 +149,12 @@ class Retrieve:
         self.index = index
         self.termWeighting = termWeighting
         
-        doc_set = set()
-        for term,doc_count in index.items():
-            doc_set = doc_set.union(set(doc_count))
-        self.doc_count = len(doc_set)
+        if np is not None:
+            self.doc_ids, self.term_to_id, self.tf = tf_matrix(index)
+            #there is a row for every document
+            self.doc_count = self.tf.shape[0]
+        else:
+            self.doc_count = len({doc for doc_count in index.values() for doc in doc_count})
           
         if termWeighting == "binary":
             self.model = BinaryModel(self,index)
@@ -81,14 +165,32 @@ class Retrieve:
         else:
             raise Exception("Unknown term weighting scheme: %s"%(termWeighting))
                 
-        self.doc_sizes = {doc:euclidean_size(vector) for doc, vector in self.model.metric().items()}
+        metric = self.model.metric()
+        if np is not None:
+            #normalise each row once so scoring is just a dot product
+            doc_norms = np.sqrt(metric.multiply(metric).sum(axis=1)).A1
+            doc_vectors = metric.copy()
+            doc_vectors.data *= np.repeat(1 / doc_norms,np.diff(metric.indptr))
+            #stored by column, so scoring only touches the documents containing
+            #each query term rather than every document
+            self.doc_vectors = doc_vectors.tocsc()
+        else:
+            #store the inverse so scoring multiplies rather than divides
+            self.inv_doc_sizes = {doc:1.0 / euclidean_size(vector) for doc, vector in metric.items()}
         
     # Method performing retrieval for specified query
     def forQuery(self, query):
         query_vector = self.model.query_metric(query)
         query_size = euclidean_size(query_vector)
-            
-        scores = {doc: similarity(query_vector,self.model.metric()[doc],sizes=[query_size, doc_size]) for doc,doc_size in self.doc_sizes.items()}
+        #normalise the query once rather than dividing every score by its size
+        query_vector = {term: weight / query_size for term, weight in query_vector.items()}
+        
+        if np is not None:
+            return self.forQuerySparse(query_vector)
+        
+        metric = self.model.metric()
+        scores = {doc: similarity(query_vector,metric[doc]) * inv_doc_size for doc,inv_doc_size in self.inv_doc_sizes.items()}
+        
         ranked = sorted(scores,key=scores.get,reverse=True)
         
         #ignoring results below a certain score seems to work better
@@ -97,28 +199,51 @@ class Retrieve:
         
         return found_docs
         
+    def forQuerySparse(self, query_vector):
+        """Scores every document at once using the columns of the query terms"""
+        #the query as parallel arrays of term ids and weights sorted by term id.
+        #query terms which are not in the index have no column, they only
+        #contributed to the size the query was normalised by
+        query_terms = {self.term_to_id[term]: weight for term, weight in query_vector.items() if term in self.term_to_id}
+        term_ids = sorted(query_terms)
+        weights = np.array([query_terms[term_id] for term_id in term_ids],dtype=float)
+        term_ids = np.array(term_ids,dtype=np.int32)
+        
+        vectors = self.doc_vectors
+        if numba is not None:
+            scores = score_documents(vectors.indptr,vectors.indices,vectors.data,term_ids,weights,vectors.shape[0])
+        else:
+            scores = vectors[:,term_ids] @ weights
+        
+        #ignoring results below a certain score seems to work better
+        #than ignoring results below a certain rank, so only the documents
+        #above the threshold need sorting
+        found = np.nonzero(scores > 0.1)[0]
+        #stable so that ties are ranked in the same order as the dict implementation
+        ranked = found[np.argsort(-scores[found],kind='stable')]
+        return [self.doc_ids[i] for i in ranked]
+        
 def euclidean_size(vector):
     return math.sqrt(
         sum( (weight ** 2) for weight in vector.values() )
     )
     
-def similarity(a,b,sizes=[None,None]):
+def similarity(a,b):
     """
-        Cosine similarity.
-        pass sizes if lengths are already known to prevent them being
-        recalculated. you may set unknown sizes to None for them to be
-        calculated
+        Dot product of two vectors, which is their cosine similarity if both
+        have been normalised to unit length
     """
-    #calculate sizes if needed
-    sizes = [ size if size is not None else euclidean_size(vec) for size,vec in zip(sizes,[a,b]) ]
-    
     #we only need to calculate the dot for terms that are shared between the
     #   query and a document, as other terms are implicitly zero so do not
-    #   contribute to the dot product
-    shared_terms = set(a) & set(b)
+    #   contribute to the dot product. probing the larger vector for each term
+    #   of the smaller one finds these without building any sets
+    small, big = (a,b) if len(a) < len(b) else (b,a)
+    big_get = big.get
     
     dot = 0
-    for term in shared_terms:
-        dot += a[term] * b[term]
+    for term, weight in small.items():
+        other = big_get(term)
+        if other is not None:
+            dot += weight * other
         
-    return dot/(sizes[0]*sizes[1])
\ No newline at end of file
+    return dot
@@ -0,0 +1,130 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+    Native versions of the huffman encode and decode loops.
+    huff-compress.py and huff-decompress.py compile this with pyximport if cython
+    is installed, otherwise they fall back to their own loops.
+    Codes are given as a dict based lut of token to (code, length) pairs of ints
+"""
+from array import array
+from collections import defaultdict
+from libc.stdint cimport uint64_t, int32_t
+
+#longest code which can be shifted into the bit buffer in one go, as up to 7
+#bits are left over from the previous token
+cdef enum:
+    MAX_FAST_CODE_LENGTH = 56
+
+def encode(tokens,lut,write,Py_ssize_t chunk_size):
+    """
+        Packs the code of each token into bytes, padding the final byte with zeros.
+        Output is passed to write in chunks of about chunk_size bytes
+    """
+    cdef uint64_t buf = 0
+    cdef int n = 0
+    cdef int length, i
+    cdef Py_ssize_t pos = 0
+    max_length = max(length for code,length in lut.values())
+    #a single token can add up to max_length bits past the end of a chunk
+    out = bytearray(chunk_size + max_length // 8 + 8)
+    cdef unsigned char[:] view = out
+    for token in tokens:
+        code, length = lut[token]
+        if length <= MAX_FAST_CODE_LENGTH:
+            buf = (buf << length) | <uint64_t>code
+            n += length
+        else:
+            #codes too long for the buffer are added a bit at a time
+            for i in range(length - 1,-1,-1):
+                buf = (buf << 1) | ((code >> i) & 1)
+                n += 1
+                if n == 8:
+                    n = 0
+                    view[pos] = buf & 0xFF
+                    pos += 1
+        while n >= 8:
+            n -= 8
+            view[pos] = (buf >> n) & 0xFF
+            pos += 1
+        if pos >= chunk_size:
+            write(out[:pos])
+            pos = 0
+    if n != 0:
+        view[pos] = (buf << (8 - n)) & 0xFF
+        pos += 1
+    write(out[:pos])
+
+def build_flat_table(lut,int table_bits):
+    """
+        Turns a lut into one flat decode table. The first level is 1 << table_bits
+        entries indexed by the next table_bits bits of input. An entry is either the
+        index of a token in the lut and its code length, or for codes longer than
+        the level the offset of the next level and minus the number of bits it is
+        indexed by. Later levels only use as many bits as their longest code needs,
+        up to table_bits, which keeps the table small for the word model
+    """
+    entry_values = array('i')
+    entry_lengths = array('b')
+    def add_level(level_lut,level_bits):
+        offset = len(entry_values)
+        entry_values.extend([0] * (1 << level_bits))
+        entry_lengths.extend([0] * (1 << level_bits))
+        long_codes = defaultdict(dict)
+        for token_index,(code,length) in level_lut.items():
+            if length <= level_bits:
+                #every index starting with this code decodes to this token
+                unused_bits = level_bits - length
+                prefix = offset + (code << unused_bits)
+                for suffix in range(1 << unused_bits):
+                    entry_values[prefix + suffix] = token_index
+                    entry_lengths[prefix + suffix] = length
+            else:
+                remaining_bits = length - level_bits
+                long_codes[code >> remaining_bits][token_index] = (code & ((1 << remaining_bits) - 1),remaining_bits)
+        for prefix,sub_lut in long_codes.items():
+            sub_bits = min(table_bits,max(length for code,length in sub_lut.values()))
+            entry_values[offset + prefix] = add_level(sub_lut,sub_bits)
+            entry_lengths[offset + prefix] = -sub_bits
+        return offset
+    add_level({token_index: code for token_index,code in enumerate(lut.values())},table_bits)
+    return entry_values, entry_lengths
+
+def decode(const unsigned char[:] data,lut,eof,int table_bits=8):
+    """
+        Decodes tokens from data until the eof token, returning them joined into a str.
+        Every code must be at least 1 bit long
+    """
+    tokens = list(lut)
+    entry_values, entry_lengths = build_flat_table(lut,table_bits)
+    cdef int32_t[:] values = entry_values
+    cdef signed char[:] lengths = entry_lengths
+    cdef int eof_index = tokens.index(eof)
+    cdef uint64_t buf = 0
+    cdef int bits_in_buf = 0
+    cdef Py_ssize_t pos = 0
+    cdef Py_ssize_t size = data.shape[0]
+    cdef int offset, index, n, level_bits
+    out = []
+    while True:
+        offset = 0
+        level_bits = table_bits
+        while True:
+            while bits_in_buf <= 56:
+                #past the end of the data read zeros, they are only ever padding
+                if pos >= size + 8:
+                    raise ValueError("compressed data has no eof")
+                buf = (buf << 8) | (data[pos] if pos < size else 0)
+                pos += 1
+                bits_in_buf += 8
+            index = offset + ((buf >> (bits_in_buf - level_bits)) & ((1 << level_bits) - 1))
+            n = lengths[index]
+            if n > 0:
+                break
+            #code is longer than this level so continue in the next one
+            offset = values[index]
+            bits_in_buf -= level_bits
+            level_bits = -n
+        bits_in_buf -= n
+        #stop reading at the eof so we don't read garbage
+        if values[index] == eof_index:
+            return ''.join(out)
+        out.append(tokens[values[index]])
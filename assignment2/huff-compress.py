@@ -4,50 +4,33 @@ import os
 import pickle
 import heapq
 from contextlib import contextmanager
-from collections import defaultdict
+from collections import Counter
 import time
 
+try:
+    from bitarray import bitarray
+    from bitarray.util import int2ba
+except ImportError:
+    #bitarray is optional, we fall back to packing bits in pure python
+    bitarray = None
+
+try:
+    import pyximport
+    pyximport.install(language_level=3)
+    import _huffman
+except ImportError:
+    #cython is optional, without it _huffman.pyx can't be compiled
+    _huffman = None
+
 #psuedo eof symbol
 #an integer cannot actually occur as a token (they are always a string), so it
 #should never be confused for a real token
 EOF_SYMBOL = -1
 
-class OutputBitstream:
-    """Class to wrap an io object abstracting bitwise operations in the writing of bits"""
-    def __init__(self,file):
-        self.file = file
-        self.buffer = []
-        
-    def write(self,bits):
-        self.buffer.extend(bits)
-        self.flush()
-            
-    def flush(self):
-        byte_list = []
-        while len(self.buffer) >= 8:
-            byte_bits = self.buffer[:8]
-            self.buffer = self.buffer[8:]
-            byte = 0
-            for bit in byte_bits:
-                byte = (byte << 1 | bit)
-            byte_list.append(byte)
-        self.file.write(bytes(byte_list))
-    
-    def write_eof(self,bits):
-        self.buffer.extend(bits)
-        padding_required = len(self.buffer) % 8
-        if padding_required != 0:
-            self.buffer.extend([0]*padding_required)
-        self.flush()
-
-@contextmanager
-def output_bitstream(file_name):
-    with open(file_name,'wb') as file:
-        output_bitstream = OutputBitstream(file)
-        try:
-            yield output_bitstream
-        finally:
-            output_bitstream.flush()
+#number of bytes of compressed output to buffer before writing
+OUTPUT_CHUNK_SIZE = 1 << 20
+
+WORD_TOKEN_RE = re.compile('[a-zA-Z]+|[^a-zA-Z]')
 
 @contextmanager            
 def bench_section(section_name,active):
@@ -58,9 +41,9 @@ def bench_section(section_name,active):
         end = time.perf_counter()
         print(f'Section {section_name} took {end-start} seconds')
 
-#Note that storing the ordering for the headp outside of the nodes lets us decrease pickle file size
+#Note that storing the ordering for the headp outside of the nodes keeps the nodes simple
 class OrderBy:
-    """Used to store probabilities of nodes outside of HNode so they can be removed when pickling"""
+    """Used to store probabilities of nodes outside of HNode"""
     def __init__(self,value,p):
         self.value = value
         self.p = p
@@ -84,62 +67,55 @@ class OrderBy:
     def __ge__(self, other):
         return self.p >= other.p
 
-#Note that splitting Hnode and HNodeLeaf both slightly decreases logic complexity, and decreases pickle file size
+#Note that splitting Hnode and HNodeLeaf slightly decreases logic complexity
 class HNodeLeaf:
     def __init__(self,value=None):
         self.value = value
         
-    def decode(self,bitstream):
-        return self.value
-                
-    def make_lut(self,bits=[],lut={}):
-        """Turns a huffman tree into a dict based lut which should be more efficient for compression"""
-        lut[self.value] = bits
-        return lut
-        
 #if using python >=3.7 this should probably be a dataclass
 class HNode:
     def __init__(self,left=None,right=None):
         self.left = left
         self.right = right
-        
-    def decode(self,bitstream):
-        bit = bitstream.popleft()
-        if bit == 0:
-            return self.left.decode(bitstream)
+
+def build_code_lengths(huffman_tree):
+    """Finds the length of the code for each token, i.e. the depth of its leaf"""
+    code_lengths = {}
+    stack = [(huffman_tree,0)]
+    while stack:
+        node, length = stack.pop()
+        if isinstance(node,HNodeLeaf):
+            code_lengths[node.value] = length
         else:
-            return self.right.decode(bitstream)
-                
-    def make_lut(self,bits=[],lut={}):
-        """Turns a huffman tree into a dict based lut which should be efficient for compression"""
-        l_bits = bits.copy()
-        l_bits.append(0)
-        r_bits = bits.copy()
-        r_bits.append(1)
-        self.left.make_lut(bits=l_bits,lut=lut)
-        self.right.make_lut(bits=r_bits,lut=lut)
-        return lut
+            stack.append((node.left,length + 1))
+            stack.append((node.right,length + 1))
+    return code_lengths
+
+def canonical_order(item):
+    """Sort key for (token, code length), putting the psuedo eof before string tokens of the same length"""
+    token, length = item
+    return (length, token != EOF_SYMBOL, token if token != EOF_SYMBOL else '')
+
+def canonical_codes(code_lengths):
+    """
+        Turns code lengths into a dict based lut of canonical huffman codes, which
+        should be efficient for compression. Each code is stored as a (code, length)
+        pair of ints. As the codes only depend on the lengths, only the lengths need
+        to be stored in the symbol model
+    """
+    lut = {}
+    code = 0
+    prev_length = 0
+    for token, length in sorted(code_lengths.items(),key=canonical_order):
+        code <<= length - prev_length
+        lut[token] = (code,length)
+        code += 1
+        prev_length = length
+    return lut
 
 def word_tokenize(str):
-    offset = 0
-    word_re = re.compile('[a-zA-Z]+')
-    tokens = []
-    remaining = len(str)
-    while offset < len(str):
-        word = word_re.search(str,offset)
-        if word:
-            word_start = word.span()[0]
-            word_end = word.span()[1]
-            pre_word = str[offset:word_start]
-            offset = word_end
-            tokens.extend(list(pre_word))
-            tokens.append(word.group())
-        else:
-            #case of dangling non-word tokens
-            tokens.extend(list(str[offset:]))
-            offset = len(str)
-        
-    return tokens
+    #a token is either a run of letters or a single non letter character
+    return WORD_TOKEN_RE.findall(str)
     
 def tokenize(infile,symbolmodel):
     with open (infile, "r") as file:
@@ -155,9 +131,8 @@ def tokenize(infile,symbolmodel):
     
 def calc_probabilites(tokens):
     total_token_count = len(tokens)
-    unique_tokens = defaultdict(int)
-    for token in tokens:
-        unique_tokens[token] += 1
+    #Counter does the counting loop in C
+    unique_tokens = Counter(tokens)
     probs = [OrderBy(HNodeLeaf(value=token),count/total_token_count) for token,count in unique_tokens.items()]
     return probs
     
@@ -171,16 +146,43 @@ def build_tree(token_probs):
         heapq.heappush(heap,OrderBy(HNode(left=l.value,right=r.value),l.p+r.p))
     return heap[0].value
     
-def compress(tokens,huffman_tree,outfile):
-    #lookup each token in the input and write its bit value to the output
+def compress(tokens,lut,outfile):
     with open(outfile,'wb') as outstream:
-        bitstream = OutputBitstream(outstream)
-        lut = huffman_tree.make_lut()
+        #a lut with a single token only contains the psuedo eof (empty input),
+        #which has an empty code that bitarray and _huffman can't encode
+        if _huffman is not None and len(lut) > 1:
+            #the whole lookup and bit packing loop runs natively
+            _huffman.encode(tokens,lut,outstream.write,OUTPUT_CHUNK_SIZE)
+            return
+        if bitarray is not None and len(lut) > 1:
+            #bitarray does the lookup and bit packing for every token in native code
+            bits = bitarray()
+            bits.encode({token: int2ba(code,length) for token,(code,length) in lut.items()},tokens)
+            #pad the final byte with zeros, the decoder stops at the psuedo eof
+            bits.fill()
+            bits.tofile(outstream)
+            return
+        #lookup each token in the input and shift its code into an integer bit
+        #buffer, moving whole bytes from it into the output as they fill up
+        out = bytearray()
+        buf = 0
+        n = 0
         for token in tokens:
-            if token == EOF_SYMBOL:
-                bitstream.write_eof(lut[token])
-            else:
-                bitstream.write(lut[token])
+            code, length = lut[token]
+            buf = buf << length | code
+            n += length
+            while n >= 8:
+                n -= 8
+                out.append((buf >> n) & 0xFF)
+            buf &= (1 << n) - 1
+            #write in large chunks so big inputs don't hold all the output in memory
+            if len(out) >= OUTPUT_CHUNK_SIZE:
+                outstream.write(out)
+                out.clear()
+        #pad the final byte with zeros, the decoder stops at the psuedo eof
+        if n != 0:
+            out.append(buf << (8 - n))
+        outstream.write(out)
 
 parser = argparse.ArgumentParser()
 parser.add_argument("infile", help="pass infile to huff-compress/decompress for compression/decompression")
@@ -199,11 +201,13 @@ with bench_section("Building symbol model",args.bench):
     tokens = tokenize(infile,args.symbolmodel)
     token_probs = calc_probabilites(tokens)
     huffman_tree = build_tree(token_probs)
+    code_lengths = build_code_lengths(huffman_tree)
 with bench_section("Encode input file",args.bench):
-    compress(tokens,huffman_tree,compressedfile)
+    compress(tokens,canonical_codes(code_lengths),compressedfile)
     
+#only the code lengths are needed to rebuild the canonical codes
 with open(pklfile,'wb') as pklstream:
-    pickle.dump(huffman_tree,pklstream,protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(code_lengths,pklstream,protocol=pickle.HIGHEST_PROTOCOL)
     
 if args.bench:
     compressed_file_size = os.stat(compressedfile).st_size
@@ -1,44 +1,35 @@
 import argparse
 import os
 import pickle
-from collections import deque
+import struct
+from collections import defaultdict
 from contextlib import contextmanager
 import time
+import itertools
+
+try:
+    from bitarray import bitarray, decodetree
+    from bitarray.util import int2ba
+except ImportError:
+    #bitarray is optional, we fall back to the pure python table decoder
+    bitarray = None
+
+try:
+    import pyximport
+    pyximport.install(language_level=3)
+    import _huffman
+except ImportError:
+    #cython is optional, without it _huffman.pyx can't be compiled
+    _huffman = None
 
 #psuedo eof symbol
 #an integer cannot actually occur as a token (they are always a string), so it
 #should never be confused for a real token
 EOF_SYMBOL = -1
 
-class InputBitstream:
-    """Class to wrap an io object abstracting bitwise operations in the reading of bits"""
-    def __init__(self,file):
-        self.file = file
-        self.buffer = deque()
-        self.bit_buffer = deque()
-        self.buffer.extend(self.file.read())
-        
-    def buffer_up(self,n):
-        while len(self.bit_buffer) < n:
-            byte = self.buffer.popleft()
-            bits = []
-            for i in range(0,8):
-                bits.append(byte & 1)
-                byte = byte >> 1
-            bits.reverse()
-            self.bit_buffer.extend(bits)
-        
-    def popleft(self):
-        if len(self.bit_buffer) == 0:
-            self.buffer_up(1)
-        return self.bit_buffer.popleft()
+#number of bits of input used to index each level of the decode table
+TABLE_BITS = 8
 
-@contextmanager
-def input_bitstream(file_name):
-    with open(file_name,'rb') as file:
-        input_bitstream = InputBitstream(file)
-        yield input_bitstream
-        
 @contextmanager            
 def bench_section(section_name,active):
     if active:
@@ -48,53 +39,105 @@ def bench_section(section_name,active):
         end = time.perf_counter()
         print(f'Section {section_name} took {end-start} seconds')
         
-class HNodeLeaf:
-    def __init__(self,value=None):
-        self.value = value
-        
-    def decode(self,bitstream):
-        return self.value
-                
-    def make_lut(self,bits=[],lut={}):
-        """Turns a huffman tree into a dict based lut which should be efficient for compression"""
-        lut[self.value] = bits
-        return lut
+def canonical_order(item):
+    """Sort key for (token, code length), putting the psuedo eof before string tokens of the same length"""
+    token, length = item
+    return (length, token != EOF_SYMBOL, token if token != EOF_SYMBOL else '')
 
-class HNode:
-    def __init__(self,left=None,right=None):
-        self.left = left
-        self.right = right
-        
-    def decode(self,bitstream):
-        bit = bitstream.popleft()
-        if bit == 0:
-            return self.left.decode(bitstream)
+def canonical_codes(code_lengths):
+    """
+        Turns the code lengths from the symbol model into a dict based lut of the
+        canonical huffman codes the compressor used. Each code is stored as a
+        (code, length) pair of ints
+    """
+    lut = {}
+    code = 0
+    prev_length = 0
+    for token, length in sorted(code_lengths.items(),key=canonical_order):
+        code <<= length - prev_length
+        lut[token] = (code,length)
+        code += 1
+        prev_length = length
+    return lut
+
+def build_decode_table(lut):
+    """
+        Turns a lut into a flat table indexed by the next TABLE_BITS bits of input.
+        Entries are (token, code length), or (subtable, None) for codes longer than
+        TABLE_BITS, where the subtable is indexed by the bits following the prefix
+    """
+    table = [None] * (1 << TABLE_BITS)
+    long_codes = defaultdict(dict)
+    for token,(code,length) in lut.items():
+        if length <= TABLE_BITS:
+            #every index starting with this code decodes to this token
+            unused_bits = TABLE_BITS - length
+            prefix = code << unused_bits
+            for suffix in range(1 << unused_bits):
+                table[prefix | suffix] = (token,length)
         else:
-            return self.right.decode(bitstream)
-                
-    def make_lut(self,bits=[],lut={}):
-        """Turns a huffman tree into a dict based lut which should be efficient for compression"""
-        l_bits = bits.copy()
-        l_bits.append(0)
-        r_bits = bits.copy()
-        r_bits.append(1)
-        self.left.make_lut(bits=l_bits,lut=lut)
-        self.right.make_lut(bits=r_bits,lut=lut)
-        return lut
-        
-def decompress(huffman_tree,compressedfile,decompressedfile):
-    #repeatedly decode and pop bits from a bitstream until the pseudo eof is encountered
+            remaining_bits = length - TABLE_BITS
+            long_codes[code >> remaining_bits][token] = (code & ((1 << remaining_bits) - 1),remaining_bits)
+    for prefix,sub_lut in long_codes.items():
+        table[prefix] = (build_decode_table(sub_lut),None)
+    return table
+
+def decompress_fast(table,data):
+    """Decodes tokens from data TABLE_BITS bits at a time until the psuedo eof"""
+    #pad to whole 64 bit words plus one more so there are always enough bits to
+    #index the table, the padding is never decoded as we stop at the psuedo eof
+    data = data + bytes(8 + -len(data) % 8)
+    #unpack every word up front in one native call rather than slicing per refill
+    words = iter(struct.unpack(f'>{len(data) // 8}Q',data))
+    mask = (1 << TABLE_BITS) - 1
+    buf = 0
+    bits_in_buf = 0
+    tokens = []
+    while True:
+        lookup = table
+        while True:
+            if bits_in_buf < TABLE_BITS:
+                #drop the consumed bits so buf doesn't grow without bound
+                buf = (buf & ((1 << bits_in_buf) - 1)) << 64 | next(words)
+                bits_in_buf += 64
+            token, n = lookup[(buf >> (bits_in_buf - TABLE_BITS)) & mask]
+            if n is not None:
+                break
+            #code is longer than TABLE_BITS so continue in the subtable
+            lookup = token
+            bits_in_buf -= TABLE_BITS
+        bits_in_buf -= n
+        #stop reading at our psuedo eof so we don't read garbage
+        if token == EOF_SYMBOL:
+            return ''.join(tokens)
+        tokens.append(token)
+
+def decompress_bitarray(lut,compressedfile,decompressedfile):
+    """Decodes using bitarray, which walks the prefix tree in native code"""
+    bits = bitarray()
+    with open(compressedfile,'rb') as infile:
+        bits.frombytes(infile.read())
+    with open(decompressedfile,'w') as outfile:
+        tree = decodetree({token: int2ba(code,length) for token,(code,length) in lut.items()})
+        #stop reading at our psuedo eof so we don't read the padding
+        tokens = itertools.takewhile(lambda token: token != EOF_SYMBOL,bits.decode(tree))
+        outfile.write(''.join(tokens))
+
+def decompress(lut,compressedfile,decompressedfile):
+    #a lut with a single token only contains the psuedo eof (empty input),
+    #which has an empty code that bitarray and _huffman can't decode
+    if _huffman is None and bitarray is not None and len(lut) > 1:
+        return decompress_bitarray(lut,compressedfile,decompressedfile)
+    with open(compressedfile,'rb') as infile:
+        data = infile.read()
+    if _huffman is not None and len(lut) > 1:
+        #the whole table lookup loop runs natively
+        with open(decompressedfile,'w') as outfile:
+            outfile.write(_huffman.decode(data,lut,EOF_SYMBOL,TABLE_BITS))
+        return
+    table = build_decode_table(lut)
     with open(decompressedfile,'w') as outfile:
-        with input_bitstream(compressedfile) as bitstream:
-            at_eof = False
-            while True:
-                token = huffman_tree.decode(bitstream)
-                at_eof = (token == EOF_SYMBOL)
-                #stop reading at our psuedo eof so we don't read garbage
-                if at_eof:
-                    break
-                outfile.write(token)
-            
+        outfile.write(decompress_fast(table,data))
 
 parser = argparse.ArgumentParser()
 parser.add_argument("infile", help="pass infile to huff-compress/decompress for compression/decompression")
@@ -109,6 +152,6 @@ decompressedfile = root +'-decompressed.txt'
 
 with bench_section("Decoding compressed file",args.bench):
     with open(pklfile,'rb') as pklstream:
-        huffman_tree = pickle.load(pklstream)
+        code_lengths = pickle.load(pklstream)
         
-    decompress(huffman_tree,compressedfile,decompressedfile)
\ No newline at end of file
+    decompress(canonical_codes(code_lengths),compressedfile,decompressedfile)
\ No newline at end of file